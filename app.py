@@ -8,277 +8,748 @@ Features:
 - View logs
 - Monitor CPU/memory
 - Per-user bot management
+
+Run with: gunicorn -c gunicorn_conf.py app:app
 """
 
-from flask import Flask, request, jsonify
+# Patch blocking stdlib calls before anything else imports them
+from gevent import monkey
+monkey.patch_all()
+
+from flask import Flask, Response, request
 from flask_cors import CORS
 import os
+import shutil
 import subprocess
 import psutil
+import select
+import signal
+import fcntl
+import hashlib
 import json
+import mmap
+import orjson
+import sqlite3
+import threading
 import time
+import uuid
 from datetime import datetime
+from werkzeug.exceptions import RequestEntityTooLarge
 from werkzeug.utils import secure_filename
+from streaming_form_data import StreamingFormDataParser
+from streaming_form_data.parser import ParseFailedException
+from streaming_form_data.targets import FileTarget, ValueTarget
 
 app = Flask(__name__)
-CORS(app)
+app.config['MAX_CONTENT_LENGTH'] = 2 * 1024 * 1024  # Bot files are tiny
+# Let browsers cache preflight results for a day so polling dashboards
+# don't send an OPTIONS request before every call
+CORS(app, resources={r"/api/*": {"origins": "*"}}, max_age=86400)
 
 # Configuration
 UPLOAD_FOLDER = '/tmp/bots'  # Free tier uses /tmp
-ALLOWED_EXTENSIONS = {'py', 'js'}
+ALLOWED_EXTENSIONS = frozenset(('py', 'js'))
 MAX_BOTS_PER_USER = 3  # Free tier limit
+CHUNK_SIZE = 65536  # Read/write block size for file and upload I/O
+STATS_INTERVAL = 2.0  # Seconds between psutil samples of a busy bot
+STATS_MAX_INTERVAL = 15.0  # Ceiling for idle bots' sampling interval
+LOG_MAX_SIZE = 8 * 1024 * 1024  # Trim bot logs once they pass 8 MB
+LOG_TRIM_INTERVAL = 10.0  # Seconds between log size checks
+STARTING_PID = 0  # pid stored in `running` while a bot is being spawned
+_UPLOAD_PREFIX = UPLOAD_FOLDER.rstrip('/') + '/'
+DB_PATH = _UPLOAD_PREFIX + 'bots.db'
 
-# In-memory storage (use database in production)
-bots_db = {}
+# Popen handles for the bots this worker started. Which bots are running
+# is tracked in the shared `running` table so any worker can stop any bot.
 running_processes = {}
+_pid_to_bot = {}  # pid -> bot_id, for reaping exited bots
+_stats_snapshot = {}  # bot_id -> (sampled_at, stats), written by _sampler
+_sampler_state = {}  # bot_id -> psutil handle and backoff for _sampler
 
 os.makedirs(UPLOAD_FOLDER, exist_ok=True)
 
-def allowed_file(filename):
-    return '.' in filename and filename.rsplit('.', 1)[1].lower() in ALLOWED_EXTENSIONS
+# Bot metadata lives in SQLite so every gunicorn worker sees the same bots
+# and it survives worker restarts
+db = sqlite3.connect(DB_PATH, check_same_thread=False, isolation_level=None)
+db.row_factory = sqlite3.Row
+db.execute('PRAGMA journal_mode=WAL')
+db.execute('PRAGMA synchronous=NORMAL')
+db.execute('''
+    CREATE TABLE IF NOT EXISTS bots (
+        id TEXT PRIMARY KEY,
+        username TEXT NOT NULL,
+        name TEXT NOT NULL,
+        filepath TEXT NOT NULL,
+        file_type TEXT NOT NULL,
+        created_at TEXT NOT NULL,
+        log_file TEXT NOT NULL
+    )
+''')
+db.execute('CREATE INDEX IF NOT EXISTS idx_username ON bots (username)')
+db.execute('''
+    CREATE TABLE IF NOT EXISTS running (
+        bot_id TEXT PRIMARY KEY,
+        pid INTEGER NOT NULL,
+        worker_pid INTEGER NOT NULL,
+        log_file TEXT NOT NULL,
+        started_at TEXT NOT NULL,
+        create_time REAL
+    )
+''')
+# Databases from before create_time was tracked
+if 'create_time' not in {col['name'] for col in db.execute('PRAGMA table_info(running)')}:
+    db.execute('ALTER TABLE running ADD COLUMN create_time REAL')
+
+def json_response(obj):
+    """Build a JSON response with orjson, which is much faster than jsonify"""
+    return app.response_class(orjson.dumps(obj), mimetype='application/json')
 
 def generate_bot_id(username, bot_name):
     timestamp = int(time.time())
     return f"{username}_{bot_name}_{timestamp}"
 
-def get_process_stats(pid):
-    """Get CPU and memory usage for a process"""
+def bot_file_stem(bot_id):
+    """Build a filesystem-safe path stem for a bot's files"""
+    # bot_id embeds user input, and secure_filename alone can map different
+    # ids to the same name (it drops non-ASCII), so add a hash of the id
+    digest = hashlib.sha1(bot_id.encode()).hexdigest()[:12]
+    return _UPLOAD_PREFIX + f"{secure_filename(bot_id)}_{digest}"
+
+def tail(path, n=1000):
+    """Return the last n lines of a file without reading all of it"""
+    with open(path, 'rb') as f:
+        # trim_log shrinks files in place; touching a mapped page past the
+        # new end would SIGBUS, so hold off trimming while we read
+        fcntl.flock(f, fcntl.LOCK_SH)
+        size = os.fstat(f.fileno()).st_size
+        if size == 0:
+            return ''
+        
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mm:
+            end = size - 1 if mm[size - 1] == ord('\n') else size
+            pos = end
+            for _ in range(n):
+                pos = mm.rfind(b'\n', 0, pos)
+                if pos == -1:
+                    break
+            return mm[pos + 1:end].decode('utf-8', 'replace')
+
+def trim_log(log_file, max_size=LOG_MAX_SIZE):
+    """Drop the oldest part of a log once it grows past max_size"""
+    try:
+        size = os.stat(log_file).st_size
+    except FileNotFoundError:
+        return
+    if size <= max_size:
+        return
+    
+    # Shift the newest half to the front in place. The bot writes with
+    # O_APPEND, so its next write lands at the new end of file.
+    with open(log_file, 'r+b') as f:
+        fcntl.flock(f, fcntl.LOCK_EX)
+        read_pos = size - max_size // 2
+        f.seek(read_pos)
+        chunk = f.read(CHUNK_SIZE)
+        start = chunk.find(b'\n') + 1  # Keep whole lines only
+        chunk = chunk[start:]
+        read_pos += start
+        write_pos = 0
+        while chunk:
+            read_pos += len(chunk)
+            f.seek(write_pos)
+            f.write(chunk)
+            write_pos += len(chunk)
+            f.seek(read_pos)
+            chunk = f.read(CHUNK_SIZE)
+        f.truncate(write_pos)
+
+def _log_trimmer():
+    """Keep running bots' logs under LOG_MAX_SIZE in the background"""
+    # Bots outlive the worker that started them, so trim every registered
+    # bot's log, not just this worker's; trim_log's flock serializes workers
+    while True:
+        try:
+            rows = db.execute('SELECT log_file FROM running').fetchall()
+        except sqlite3.Error:
+            rows = []
+        for row in rows:
+            try:
+                trim_log(row['log_file'])
+            except OSError:
+                pass
+        time.sleep(LOG_TRIM_INTERVAL)
+
+def get_bot(bot_id):
+    """Get a bot's metadata as a dict, or None if it doesn't exist"""
+    row = db.execute('SELECT * FROM bots WHERE id = ?', (bot_id,)).fetchone()
+    return dict(row) if row else None
+
+def get_running(bot_id):
+    """Get a bot's entry in the shared running registry, or None"""
+    row = db.execute('SELECT * FROM running WHERE bot_id = ?', (bot_id,)).fetchone()
+    return dict(row) if row else None
+
+def pid_alive(pid):
+    """Check /proc for a process that exists and isn't a zombie"""
+    try:
+        with open(f'/proc/{pid}/stat', 'rb') as f:
+            stat = f.read()
+    except OSError:
+        # ENOENT, or ESRCH if it exited between open() and read()
+        return False
+    # The state field follows the parenthesised command name
+    end = stat.rfind(b')')
+    if end == -1:
+        return False  # Empty read from a process that just went away
+    return stat[end + 2:end + 3] != b'Z'
+
+def wait_for_exit(pidfd, timeout):
+    """Wait for a pidfd to report its process exited; False on timeout"""
+    # gevent drops select.poll, but its select() watches the fd cooperatively
+    ready, _, _ = select.select([pidfd], [], [], timeout)
+    return bool(ready)
+
+def send_signal(pidfd, sig):
+    """Signal a process through its pidfd, ignoring ones that already exited"""
+    try:
+        signal.pidfd_send_signal(pidfd, sig)
+    except ProcessLookupError:
+        pass  # Already gone
+
+def same_process(pid, create_time):
+    """Check that pid still belongs to the process started at create_time"""
+    try:
+        return create_time is not None and psutil.Process(pid).create_time() == create_time
+    except psutil.NoSuchProcess:
+        return False
+
+def terminate_bot(bot_id, pid, create_time):
+    """Stop a bot started by any worker; return True if it had to be killed"""
+    # Work on our own pidfd: for this worker's children a dup, so the
+    # reaper closing the stored one can't leave us signalling a reused fd
+    # number; for other workers' bots a fresh one, checked against the
+    # recorded create_time so a recycled pid is never signalled
+    info = running_processes.get(bot_id)
+    try:
+        if info is not None and info['pid'] == pid:
+            pidfd = os.dup(info['pidfd'])
+        else:
+            pidfd = os.pidfd_open(pid)
+            if not same_process(pid, create_time):
+                os.close(pidfd)
+                pidfd = None
+    except OSError:
+        pidfd = None  # Already exited
+    
+    if pidfd is None:
+        forget_process(bot_id, pid)
+        return False
+    
     try:
+        send_signal(pidfd, signal.SIGTERM)
+        forced = not wait_for_exit(pidfd, 5)
+        if forced:
+            send_signal(pidfd, signal.SIGKILL)
+    finally:
+        os.close(pidfd)
+    
+    if info is not None and info['pid'] == pid and not forced:
+        info['process'].poll()  # Reap it now rather than on the next sampler round
+    
+    forget_process(bot_id, pid)
+    return forced
+
+def sample_bot(bot_id, pid, create_time, now):
+    """Take one psutil sample for a running bot, backing off while it idles"""
+    state = _sampler_state.get(bot_id)
+    if state is None or state['pid'] != pid:
         process = psutil.Process(pid)
-        cpu = process.cpu_percent(interval=0.1)
+        if process.create_time() != create_time:
+            raise psutil.NoSuchProcess(pid)  # pid was recycled
+        state = {
+            'pid': pid,
+            'process': process,
+            'interval': STATS_INTERVAL,
+            'quiet': 0,
+            'due': now
+        }
+        _sampler_state[bot_id] = state
+    
+    if now < state['due']:
+        return
+    
+    # Reuse the Process object so cpu_percent() measures since the last
+    # sample instead of blocking to take its own
+    process = state['process']
+    with process.oneshot():
+        cpu = process.cpu_percent(interval=None)
         memory = process.memory_info().rss / (1024 * 1024)  # MB
-        return {'cpu': round(cpu, 2), 'memory': round(memory, 2)}
-    except:
+    
+    # Idle bots with flat memory get sampled less and less often
+    previous = _stats_snapshot.get(bot_id)
+    if previous and cpu < 1 and abs(memory - previous[1]['memory']) < 1:
+        state['quiet'] += 1
+        if state['quiet'] >= 2:
+            state['interval'] = min(state['interval'] * 1.5, STATS_MAX_INTERVAL)
+    else:
+        state['quiet'] = 0
+        state['interval'] = STATS_INTERVAL
+    
+    state['due'] = now + state['interval']
+    _stats_snapshot[bot_id] = (now, {'cpu': round(cpu, 2), 'memory': round(memory, 2)})
+
+def sample_round():
+    """Sample every registered bot once and drop state for stopped ones"""
+    now = time.monotonic()
+    rows = db.execute('SELECT bot_id, pid, worker_pid, create_time FROM running').fetchall()
+    for row in rows:
+        if row['pid'] == STARTING_PID:
+            # A start in progress; only stale if its worker died mid-spawn
+            if not pid_alive(row['worker_pid']):
+                db.execute(
+                    'DELETE FROM running WHERE bot_id = ? AND pid = ?',
+                    (row['bot_id'], STARTING_PID)
+                )
+            continue
+        try:
+            sample_bot(row['bot_id'], row['pid'], row['create_time'], now)
+        except psutil.Error:
+            _sampler_state.pop(row['bot_id'], None)
+            _stats_snapshot.pop(row['bot_id'], None)
+            # The process is gone. Clear its row if it was ours (reaping may
+            # have failed to) or its worker died without reaping it.
+            if row['worker_pid'] == os.getpid() or not pid_alive(row['worker_pid']):
+                db.execute(
+                    'DELETE FROM running WHERE bot_id = ? AND pid = ?',
+                    (row['bot_id'], row['pid'])
+                )
+    
+    # Drop state for bots that stopped since the last round
+    running_ids = {row['bot_id'] for row in rows}
+    for bot_id in list(_sampler_state):
+        if bot_id not in running_ids:
+            _sampler_state.pop(bot_id, None)
+            _stats_snapshot.pop(bot_id, None)
+
+def _sampler():
+    """Poll CPU/memory and reap exited bots in the background"""
+    # This thread is the only place bots get reaped, so one bad round
+    # (e.g. 'database is locked') must not end it
+    while True:
+        try:
+            sample_round()
+        except Exception:
+            app.logger.exception('Stats sampling round failed')
+        
+        try:
+            reap_children()
+        except Exception:
+            app.logger.exception('Reaping exited bots failed')
+        
+        time.sleep(STATS_INTERVAL)
+
+def reap_children():
+    """Reap exited bots so they drop out of the running registry right away"""
+    while True:
+        try:
+            pid, _ = os.waitpid(-1, os.WNOHANG)
+        except ChildProcessError:
+            break  # No children at all
+        if pid == 0:
+            break  # Children left, none exited
+        bot_id = _pid_to_bot.get(pid)
+        if bot_id is not None:
+            forget_process(bot_id, pid)
+
+def get_process_stats(bot_id):
+    """Get the latest sampled CPU and memory usage for a running bot"""
+    snapshot = _stats_snapshot.get(bot_id)
+    if snapshot is None:
         return {'cpu': 0, 'memory': 0}
+    return snapshot[1]
+
+def forget_process(bot_id, pid):
+    """Drop a stopped bot's process record and cached stats"""
+    info = running_processes.get(bot_id)
+    if info is not None and info['pid'] == pid:
+        del running_processes[bot_id]
+        os.close(info['pidfd'])
+    _pid_to_bot.pop(pid, None)
+    _sampler_state.pop(bot_id, None)
+    _stats_snapshot.pop(bot_id, None)
+    # Match on pid too, in case the bot was already restarted elsewhere
+    db.execute('DELETE FROM running WHERE bot_id = ? AND pid = ?', (bot_id, pid))
+
+threading.Thread(target=_sampler, daemon=True).start()
+threading.Thread(target=_log_trimmer, daemon=True).start()
+
+def bot_summary(bot, started_at):
+    """Build the public view of a bot, with live stats if it's running"""
+    if started_at is None:
+        return {
+            'id': bot['id'],
+            'name': bot['name'],
+            'status': 'stopped',
+            'cpu': 0,
+            'memory': 0,
+            'created_at': bot['created_at']
+        }
+    
+    stats = get_process_stats(bot['id'])
+    return {
+        'id': bot['id'],
+        'name': bot['name'],
+        'status': 'running',
+        'cpu': stats['cpu'],
+        'memory': stats['memory'],
+        'created_at': bot['created_at'],
+        'started_at': started_at
+    }
 
 @app.route('/api/health', methods=['GET'])
 def health_check():
-    return jsonify({'status': 'ok', 'timestamp': datetime.now().isoformat()})
+    return json_response({'status': 'ok', 'timestamp': datetime.now().isoformat()})
 
 @app.route('/api/bots/<username>', methods=['GET'])
 def get_user_bots(username):
     """Get all bots for a user"""
     user_bots = []
     
-    for bot_id, bot_data in bots_db.items():
-        if bot_data['username'] == username:
-            bot_info = bot_data.copy()
-            
-            # Update stats if running
-            if bot_id in running_processes:
-                pid = running_processes[bot_id]['pid']
-                stats = get_process_stats(pid)
-                bot_info['cpu'] = stats['cpu']
-                bot_info['memory'] = stats['memory']
-                bot_info['status'] = 'running'
-            else:
-                bot_info['cpu'] = 0
-                bot_info['memory'] = 0
-                bot_info['status'] = 'stopped'
-            
-            user_bots.append(bot_info)
-    
-    return jsonify({'success': True, 'bots': user_bots})
-
-@app.route('/api/bot/upload', methods=['POST'])
-def upload_bot():
-    """Upload a new bot file"""
-    if 'bot_file' not in request.files:
-        return jsonify({'success': False, 'message': 'No file uploaded'}), 400
-    
-    file = request.files['bot_file']
-    username = request.form.get('username')
-    bot_name = request.form.get('bot_name')
+    rows = db.execute(
+        '''SELECT b.id, b.name, b.created_at, r.started_at
+           FROM bots b LEFT JOIN running r ON r.bot_id = b.id
+           WHERE b.username = ? ORDER BY b.created_at''',
+        (username,)
+    )
+    for row in rows:
+        user_bots.append(bot_summary(row, row['started_at']))
     
+    return json_response({'success': True, 'bots': user_bots})
+
+def too_large():
+    """Error response for an upload over MAX_CONTENT_LENGTH"""
+    limit_mb = app.config['MAX_CONTENT_LENGTH'] // (1024 * 1024)
+    return json_response({'success': False, 'message': f'File too large (max {limit_mb} MB)'}), 413
+
+def check_content_length():
+    """Return an error response if the declared upload size is over the limit"""
+    if request.content_length and request.content_length > app.config['MAX_CONTENT_LENGTH']:
+        return too_large()
+    return None
+
+def check_upload(username, bot_name):
+    """Return an error response if the user can't upload another bot"""
     if not username or not bot_name:
-        return jsonify({'success': False, 'message': 'Missing username or bot_name'}), 400
+        return json_response({'success': False, 'message': 'Missing username or bot_name'}), 400
     
     # Check user bot limit
-    user_bot_count = sum(1 for b in bots_db.values() if b['username'] == username)
+    user_bot_count = db.execute(
+        'SELECT COUNT(*) FROM bots WHERE username = ?', (username,)
+    ).fetchone()[0]
     if user_bot_count >= MAX_BOTS_PER_USER:
-        return jsonify({
+        return json_response({
             'success': False, 
             'message': f'Free tier limit: {MAX_BOTS_PER_USER} bots per user'
         }), 403
     
-    if file and allowed_file(file.filename):
-        bot_id = generate_bot_id(username, bot_name)
-        filename = secure_filename(f"{bot_id}.{file.filename.rsplit('.', 1)[1]}")
-        filepath = os.path.join(UPLOAD_FOLDER, filename)
+    return None
+
+def register_bot(username, bot_name, part_path, file_type):
+    """Store bot metadata, move its uploaded file into place and build the response"""
+    bot_id = generate_bot_id(username, bot_name)
+    stem = bot_file_stem(bot_id)
+    filepath = f"{stem}.{file_type}"
+    
+    # Insert before moving the file so a duplicate id can't overwrite
+    # another bot's file
+    try:
+        db.execute(
+            '''INSERT INTO bots
+               (id, username, name, filepath, file_type, created_at, log_file)
+               VALUES (?, ?, ?, ?, ?, ?, ?)''',
+            (bot_id, username, bot_name, filepath, file_type,
+             datetime.now().isoformat(), f"{stem}.log")
+        )
+    except sqlite3.IntegrityError:
+        return json_response({
+            'success': False,
+            'message': 'A bot with this name was just uploaded, try again'
+        }), 409
+    
+    os.replace(part_path, filepath)
+    
+    return json_response({
+        'success': True, 
+        'message': 'Bot uploaded successfully',
+        'bot_id': bot_id
+    })
+
+@app.route('/api/bot/upload', methods=['POST'])
+def upload_bot():
+    """Upload a new bot file"""
+    error = check_content_length()
+    if error:
+        return error
+    
+    # Parse the multipart body straight off the socket instead of going
+    # through werkzeug's form parser and its spooled temp file
+    part_path = _UPLOAD_PREFIX + f"upload_{uuid.uuid4().hex}.part"
+    file_target = FileTarget(part_path)
+    username_target = ValueTarget()
+    bot_name_target = ValueTarget()
+    
+    try:
+        parser = StreamingFormDataParser(headers=request.headers)
+    except ParseFailedException:
+        # Not a multipart/form-data request at all
+        return json_response({'success': False, 'message': 'No file uploaded'}), 400
+    parser.register('bot_file', file_target)
+    parser.register('username', username_target)
+    parser.register('bot_name', bot_name_target)
+    
+    try:
+        try:
+            while chunk := request.stream.read(CHUNK_SIZE):
+                parser.data_received(chunk)
+        except RequestEntityTooLarge:
+            return too_large()
+        except Exception as e:
+            return json_response({'success': False, 'message': f'Invalid upload: {str(e)}'}), 400
         
-        file.save(filepath)
+        filename = file_target.multipart_filename
+        if not filename:
+            return json_response({'success': False, 'message': 'No file uploaded'}), 400
         
-        # Store bot metadata
-        bots_db[bot_id] = {
-            'id': bot_id,
-            'name': bot_name,
-            'username': username,
-            'filepath': filepath,
-            'file_type': file.filename.rsplit('.', 1)[1],
-            'created_at': datetime.now().isoformat(),
-            'status': 'stopped'
-        }
+        username = username_target.value.decode('utf-8', 'replace')
+        bot_name = bot_name_target.value.decode('utf-8', 'replace')
         
-        return jsonify({
-            'success': True, 
-            'message': 'Bot uploaded successfully',
-            'bot_id': bot_id
-        })
+        error = check_upload(username, bot_name)
+        if error:
+            return error
+        
+        _, dot, ext = filename.rpartition('.')
+        ext = ext.lower()
+        if not dot or ext not in ALLOWED_EXTENSIONS:
+            return json_response({'success': False, 'message': 'Invalid file type'}), 400
+        
+        return register_bot(username, bot_name, part_path, ext)
+    
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
+
+@app.route('/api/bot/upload_stream', methods=['POST'])
+def upload_bot_stream():
+    """Upload a new bot file sent as the raw request body"""
+    username = request.args.get('username')
+    bot_name = request.args.get('bot_name')
+    ext = request.args.get('ext', '').lower()
+    
+    error = check_content_length() or check_upload(username, bot_name)
+    if error:
+        return error
+    
+    if ext not in ALLOWED_EXTENSIONS:
+        return json_response({'success': False, 'message': 'Invalid file type'}), 400
     
-    return jsonify({'success': False, 'message': 'Invalid file type'}), 400
+    # Write to a side file and rename it into place, so start_bot can never
+    # see a partial upload
+    part_path = _UPLOAD_PREFIX + f"upload_{uuid.uuid4().hex}.part"
+    try:
+        with open(part_path, 'wb') as out:
+            if request.content_length:
+                # Reserve the whole file up front instead of growing it per block
+                os.posix_fallocate(out.fileno(), 0, request.content_length)
+            shutil.copyfileobj(request.stream, out, CHUNK_SIZE)
+            out.truncate()
+            out.flush()
+            os.fsync(out.fileno())
+        
+        return register_bot(username, bot_name, part_path, ext)
+    except RequestEntityTooLarge:
+        # Chunked bodies have no Content-Length, so the limit trips mid-copy
+        return too_large()
+    finally:
+        if os.path.exists(part_path):
+            os.remove(part_path)
 
 @app.route('/api/bot/start/<bot_id>', methods=['POST'])
 def start_bot(bot_id):
     """Start a bot"""
-    if bot_id not in bots_db:
-        return jsonify({'success': False, 'message': 'Bot not found'}), 404
+    bot = get_bot(bot_id)
+    if bot is None:
+        return json_response({'success': False, 'message': 'Bot not found'}), 404
     
-    if bot_id in running_processes:
-        return jsonify({'success': False, 'message': 'Bot already running'}), 400
-    
-    bot = bots_db[bot_id]
     filepath = bot['filepath']
     file_type = bot['file_type']
+    log_file = bot['log_file']
     
+    # Determine how to run the bot
+    if file_type == 'py':
+        cmd = ['python3', filepath]
+    elif file_type == 'js':
+        cmd = ['node', filepath]
+    else:
+        return json_response({'success': False, 'message': 'Unsupported file type'}), 400
+    
+    # Claim the bot before spawning so concurrent starts, from this worker
+    # or another, can't both run it. The pid is filled in once it exists.
+    started_at = datetime.now().isoformat()
     try:
-        # Determine how to run the bot
-        if file_type == 'py':
-            cmd = ['python3', filepath]
-        elif file_type == 'js':
-            cmd = ['node', filepath]
-        else:
-            return jsonify({'success': False, 'message': 'Unsupported file type'}), 400
-        
-        # Start the process
-        log_file = os.path.join(UPLOAD_FOLDER, f"{bot_id}.log")
-        with open(log_file, 'w') as log:
+        db.execute(
+            '''INSERT INTO running (bot_id, pid, worker_pid, log_file, started_at)
+               VALUES (?, ?, ?, ?, ?)''',
+            (bot_id, STARTING_PID, os.getpid(), log_file, started_at)
+        )
+    except sqlite3.IntegrityError:
+        return json_response({'success': False, 'message': 'Bot already running'}), 400
+    
+    try:
+        # Start the process. The bot writes straight to its log, so it
+        # doesn't depend on this worker staying alive.
+        log_fd = os.open(log_file, os.O_CREAT | os.O_WRONLY | os.O_APPEND, 0o644)
+        try:
+            # The log is only ever appended to and read back sequentially
+            os.posix_fadvise(log_fd, 0, 0, os.POSIX_FADV_SEQUENTIAL)
             process = subprocess.Popen(
                 cmd,
-                stdout=log,
+                stdout=log_fd,
                 stderr=subprocess.STDOUT,
                 cwd=UPLOAD_FOLDER
             )
-        
+        finally:
+            os.close(log_fd)
+    
+    except Exception as e:
+        db.execute(
+            'DELETE FROM running WHERE bot_id = ? AND pid = ?', (bot_id, STARTING_PID)
+        )
+        return json_response({'success': False, 'message': f'Failed to start bot: {str(e)}'}), 500
+    
+    # Pin the process before anything else can yield and let it be reaped,
+    # and record its start time so other workers can tell if the pid is reused
+    try:
+        pidfd = os.pidfd_open(process.pid)
+        create_time = psutil.Process(process.pid).create_time()
+    except ProcessLookupError:
+        # It already exited and was reaped, so it's simply a stopped bot
+        pidfd = None
+    except psutil.NoSuchProcess:
+        os.close(pidfd)
+        pidfd = None
+    
+    if pidfd is None:
+        db.execute(
+            'DELETE FROM running WHERE bot_id = ? AND pid = ?', (bot_id, STARTING_PID)
+        )
+    else:
         running_processes[bot_id] = {
             'pid': process.pid,
             'process': process,
+            'pidfd': pidfd,
             'log_file': log_file,
-            'started_at': datetime.now().isoformat()
+            'started_at': started_at
         }
-        
-        return jsonify({
-            'success': True, 
-            'message': 'Bot started successfully',
-            'pid': process.pid
-        })
+        _pid_to_bot[process.pid] = bot_id
+        db.execute(
+            'UPDATE running SET pid = ?, create_time = ? WHERE bot_id = ? AND pid = ?',
+            (process.pid, create_time, bot_id, STARTING_PID)
+        )
     
-    except Exception as e:
-        return jsonify({'success': False, 'message': f'Failed to start bot: {str(e)}'}), 500
+    return json_response({
+        'success': True, 
+        'message': 'Bot started successfully',
+        'pid': process.pid
+    })
 
 @app.route('/api/bot/stop/<bot_id>', methods=['POST'])
 def stop_bot(bot_id):
     """Stop a running bot"""
-    if bot_id not in running_processes:
-        return jsonify({'success': False, 'message': 'Bot is not running'}), 400
+    running = get_running(bot_id)
+    if running is None:
+        return json_response({'success': False, 'message': 'Bot is not running'}), 400
+    
+    if running['pid'] == STARTING_PID:
+        return json_response({'success': False, 'message': 'Bot is still starting'}), 409
     
     try:
-        process = running_processes[bot_id]['process']
-        process.terminate()
-        process.wait(timeout=5)
+        if terminate_bot(bot_id, running['pid'], running['create_time']):
+            return json_response({'success': True, 'message': 'Bot force-stopped'})
         
-        del running_processes[bot_id]
-        
-        return jsonify({'success': True, 'message': 'Bot stopped successfully'})
-    
-    except subprocess.TimeoutExpired:
-        process.kill()
-        del running_processes[bot_id]
-        return jsonify({'success': True, 'message': 'Bot force-stopped'})
+        return json_response({'success': True, 'message': 'Bot stopped successfully'})
     
     except Exception as e:
-        return jsonify({'success': False, 'message': f'Failed to stop bot: {str(e)}'}), 500
+        return json_response({'success': False, 'message': f'Failed to stop bot: {str(e)}'}), 500
 
 @app.route('/api/bot/delete/<bot_id>', methods=['DELETE'])
 def delete_bot(bot_id):
     """Delete a bot"""
-    if bot_id not in bots_db:
-        return jsonify({'success': False, 'message': 'Bot not found'}), 404
+    bot = get_bot(bot_id)
+    if bot is None:
+        return json_response({'success': False, 'message': 'Bot not found'}), 404
     
     # Stop if running
-    if bot_id in running_processes:
+    running = get_running(bot_id)
+    if running is not None and running['pid'] == STARTING_PID:
+        return json_response({'success': False, 'message': 'Bot is still starting'}), 409
+    
+    if running is not None:
         try:
-            process = running_processes[bot_id]['process']
-            process.terminate()
-            process.wait(timeout=5)
-            del running_processes[bot_id]
+            terminate_bot(bot_id, running['pid'], running['create_time'])
         except:
             pass
     
     # Delete files
-    bot = bots_db[bot_id]
     try:
         if os.path.exists(bot['filepath']):
             os.remove(bot['filepath'])
         
-        log_file = os.path.join(UPLOAD_FOLDER, f"{bot_id}.log")
-        if os.path.exists(log_file):
-            os.remove(log_file)
+        if os.path.exists(bot['log_file']):
+            os.remove(bot['log_file'])
     except:
         pass
     
     # Remove from database
-    del bots_db[bot_id]
+    db.execute('DELETE FROM bots WHERE id = ?', (bot_id,))
     
-    return jsonify({'success': True, 'message': 'Bot deleted successfully'})
+    return json_response({'success': True, 'message': 'Bot deleted successfully'})
 
 @app.route('/api/bot/logs/<bot_id>', methods=['GET'])
 def get_bot_logs(bot_id):
     """Get bot logs"""
-    if bot_id not in bots_db:
-        return jsonify({'success': False, 'message': 'Bot not found'}), 404
+    bot = get_bot(bot_id)
+    if bot is None:
+        return json_response({'success': False, 'message': 'Bot not found'}), 404
     
-    log_file = os.path.join(UPLOAD_FOLDER, f"{bot_id}.log")
+    log_file = bot['log_file']
     
     if not os.path.exists(log_file):
-        return jsonify({'success': True, 'logs': 'No logs available yet'})
+        # No log file yet: an empty body, so it can't be mistaken for log text
+        return Response('', mimetype='text/plain')
     
     try:
-        with open(log_file, 'r') as f:
-            logs = f.read()
-        
-        # Return last 1000 lines to avoid huge responses
-        lines = logs.split('\n')
-        if len(lines) > 1000:
-            logs = '\n'.join(lines[-1000:])
+        # Return last 1000 lines to avoid huge responses. Sent as plain
+        # text so the log doesn't have to be JSON-escaped.
+        logs = tail(log_file, 1000)
         
-        return jsonify({'success': True, 'logs': logs})
+        return Response(logs, mimetype='text/plain')
     
     except Exception as e:
-        return jsonify({'success': False, 'message': f'Failed to read logs: {str(e)}'}), 500
+        return json_response({'success': False, 'message': f'Failed to read logs: {str(e)}'}), 500
 
 @app.route('/api/bot/status/<bot_id>', methods=['GET'])
 def get_bot_status(bot_id):
     """Get detailed bot status"""
-    if bot_id not in bots_db:
-        return jsonify({'success': False, 'message': 'Bot not found'}), 404
-    
-    bot = bots_db[bot_id].copy()
-    
-    if bot_id in running_processes:
-        pid = running_processes[bot_id]['pid']
-        stats = get_process_stats(pid)
-        bot['status'] = 'running'
-        bot['cpu'] = stats['cpu']
-        bot['memory'] = stats['memory']
-        bot['started_at'] = running_processes[bot_id]['started_at']
-    else:
-        bot['status'] = 'stopped'
-        bot['cpu'] = 0
-        bot['memory'] = 0
+    bot = get_bot(bot_id)
+    if bot is None:
+        return json_response({'success': False, 'message': 'Bot not found'}), 404
     
-    return jsonify({'success': True, 'bot': bot})
+    running = get_running(bot_id)
+    started_at = running['started_at'] if running else None
+    response = json_response({'success': True, 'bot': bot_summary(bot, started_at)})
+    # Stats only refresh every couple of seconds, so let clients reuse them
+    response.headers['Cache-Control'] = f'private, max-age={int(STATS_INTERVAL)}'
+    return response
 
-if __name__ == '__main__':
-    # For Render deployment
-    port = int(os.environ.get('PORT', 10000))
-    app.run(host='0.0.0.0', port=port, debug=False)
+# For Render deployment, serve with gunicorn + gevent workers:
+#   gunicorn -c gunicorn_conf.py app:app
@@ -0,0 +1,21 @@
+"""
+Gunicorn config for the bot hosting API
+
+Run with: gunicorn -c gunicorn_conf.py app:app
+"""
+
+import os
+
+# Bind to the port Render assigns
+bind = f"0.0.0.0:{os.environ.get('PORT', 10000)}"
+
+# The API is all subprocess/file/psutil I/O, so gevent greenlets
+# let one worker serve many requests concurrently
+worker_class = 'gevent'
+workers = 2
+worker_connections = 1000
+
+# Dashboards poll status/logs every few seconds; keep their connections
+# open between polls (longer than typical proxy idle timeouts)
+keepalive = 65
+timeout = 120